@@ -27,7 +27,10 @@
 import argparse
 import datetime
 import difflib
+import functools
 import html
+import itertools
+import operator
 import sys
 
 from py import archive, log, mohfw
@@ -53,38 +56,210 @@ corresponding markups:
 
 
 import datetime
+import http.client
 import re
 import urllib
+import urllib.error
 import urllib.request
 
 
 WIKI_SRC1 = 'Template:COVID-19_pandemic_data/India_medical_cases_chart'
 WIKI_SRC2 = 'Template:COVID-19_pandemic_data/India_medical_cases_by_state_and_union_territory'
 WIKI_SRC3 = 'COVID-19_pandemic_in_India/Statistics'
-
-
+WIKI_HOST = 'en.wikipedia.org'
+
+# Table cell markup for zero case numbers.
+_GRAY_ZERO = ' style="color:gray;" |0'
+
+# Regions listed in the region table, in display order.
+_REGION_NAMES = (
+    'Andaman and Nicobar Islands',
+    'Andhra Pradesh',
+    'Arunachal Pradesh',
+    'Assam',
+    'Bihar',
+    'Chandigarh',
+    'Chhattisgarh',
+    'Dadra and Nagar Haveli and Daman and Diu',
+    'Delhi',
+    'Goa',
+    'Gujarat',
+    'Haryana',
+    'Himachal Pradesh',
+    'Jammu and Kashmir',
+    'Jharkhand',
+    'Karnataka',
+    'Kerala',
+    'Ladakh',
+    'Lakshadweep',
+    'Madhya Pradesh',
+    'Maharashtra',
+    'Manipur',
+    'Meghalaya',
+    'Mizoram',
+    'Nagaland',
+    'Odisha',
+    'Puducherry',
+    'Punjab',
+    'Rajasthan',
+    'Sikkim',
+    'Tamil Nadu',
+    'Telangana',
+    'Tripura',
+    'Uttarakhand',
+    'Uttar Pradesh',
+    'West Bengal',
+)
+
+# Regions that have their own COVID-19 pandemic article on Wikipedia.
+_LINKED_REGIONS = frozenset((
+    'Andhra Pradesh',
+    'Arunachal Pradesh',
+    'Assam',
+    'Bihar',
+    'Chandigarh',
+    'Chhattisgarh',
+    'Dadra and Nagar Haveli and Daman and Diu',
+    'Delhi',
+    'Goa',
+    'Gujarat',
+    'Haryana',
+    'Himachal Pradesh',
+    'Jammu and Kashmir',
+    'Jharkhand',
+    'Karnataka',
+    'Kerala',
+    'Ladakh',
+    'Madhya Pradesh',
+    'Maharashtra',
+    'Manipur',
+    'Meghalaya',
+    'Mizoram',
+    'Nagaland',
+    'Odisha',
+    'Puducherry',
+    'Rajasthan',
+    'Sikkim',
+    'Tamil Nadu',
+    'Telangana',
+    'Tripura',
+    'Uttarakhand',
+    'Uttar Pradesh',
+    'West Bengal',
+))
+
+
+_wiki_conn = None
+
+
+def wiki_get(path):
+    """Return response body for path on Wikipedia over a shared connection.
+
+    The connection is kept alive and reused by subsequent calls so that
+    the TCP and TLS handshakes happen once per run. If the server has
+    closed the idle connection, reconnect and retry once.
+    """
+    global _wiki_conn
+    headers = {'User-Agent': 'Python-urllib/' + urllib.request.__version__}
+    for attempt in range(2):
+        if _wiki_conn is None:
+            _wiki_conn = http.client.HTTPSConnection(WIKI_HOST)
+        try:
+            _wiki_conn.request('GET', path, headers=headers)
+            response = _wiki_conn.getresponse()
+            body = response.read()
+            break
+        except (http.client.HTTPException, ConnectionError):
+            _wiki_conn.close()
+            _wiki_conn = None
+            if attempt == 1:
+                raise
+    if response.status != 200:
+        raise urllib.error.HTTPError('https://' + WIKI_HOST + path,
+                                     response.status, response.reason,
+                                     response.msg, None)
+    return body
+
+
+@functools.lru_cache(maxsize=None)
 def fetch_wiki_source(article_name):
     """Return Wikitext from specified Wikipedia article."""
-    src_url = ('https://en.wikipedia.org/w/index.php?title={}&action=edit'
-               .format(article_name))
-    log.log('Fetching wikitext for {} ...', src_url)
-    response = urllib.request.urlopen(src_url).read().decode('utf-8')
-    source = re.search(r'(?s)<textarea .*?>(.*)</textarea>', response).group(1)
+    src_path = '/w/index.php?title={}&action=edit'.format(article_name)
+    log.log('Fetching wikitext for https://{}{} ...', WIKI_HOST, src_path)
+    response = wiki_get(src_path)
+    # Decode only the wikitext within the textarea, not the page chrome.
+    begin = response.index(b'>', response.index(b'<textarea ')) + 1
+    end = response.rindex(b'</textarea>')
+    source = response[begin:end].decode('utf-8')
     source = html.unescape(source)
     return source
 
 
+@functools.lru_cache(maxsize=None)
+def _compile_pair(begin_re, end_re):
+    """Return compiled pattern that matches text between two delimiters."""
+    return re.compile(r'(?s)(' + begin_re + r')(?:.*?)(' + end_re + r')')
+
+
 def replace_within(begin_re, end_re, source, data):
     """Replace text in source between two delimeters with specified data."""
-    pattern = r'(?s)(' + begin_re + r')(?:.*?)(' + end_re + r')'
-    source = re.sub(pattern, r'\1@@REPL@@\2' , source)
-    if '@@REPL@@' in source:
-        source = source.replace('@@REPL@@', data)
-    else:
-        log.log('')
-        log.log('ERROR: Cannot match /{}/ and /{}/'.format(begin_re, end_re))
-        log.log('')
-    return source
+    return replace_all_within(source, [(begin_re, end_re, data)])
+
+
+def replace_all_within(source, replacements):
+    """Replace text between several pairs of delimiters in a single pass.
+
+    Each item in replacements is a (begin_re, end_re, data) triple. All
+    delimiter pairs are matched against the original source and the
+    result is assembled once.
+    """
+    spans = []
+    for begin_re, end_re, data in replacements:
+        match = _compile_pair(begin_re, end_re).search(source)
+        if match is None:
+            log.log('')
+            log.log('ERROR: Cannot match /{}/ and /{}/', begin_re, end_re)
+            log.log('')
+            continue
+        spans.append((match.end(1), match.start(2), data))
+
+    out = []
+    pos = 0
+    for start, end, data in sorted(spans, key=lambda span: span[:2]):
+        if start < pos:
+            log.log('')
+            log.log('ERROR: Overlapping replacement at offset {}', start)
+            log.log('')
+            continue
+        out.append(source[pos:start])
+        out.append(data)
+        pos = end
+    out.append(source[pos:])
+    return ''.join(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_layout(filename):
+    """Return stripped content of specified layout file."""
+    with open(filename) as f:
+        return f.read().strip()
+
+
+@functools.lru_cache(maxsize=8)
+def load_archive(ignore_dates):
+    """Return archive data loaded once per tuple of ignored dates."""
+    return archive.load(ignore_dates=ignore_dates)
+
+
+def _csv(values):
+    """Return comma separated string representation of values."""
+    return ', '.join(map(str, values))
+
+
+def fwrite(filename, text):
+    """Write content to file and close the file."""
+    with open(filename, 'w') as f:
+        f.write(text)
 
 
 def diff(a, b):
@@ -94,34 +269,33 @@ def diff(a, b):
     return ''.join(out)
 
 
+@functools.lru_cache(maxsize=1024)
 def cf(x):
     """Return tick label for Indian-style comma delimited numbers."""
     x = str(int(x))
-    result = x[-3:]
-    i = len(x) - 3
-    while i > 0:
-        i -= 2
-        j = i + 2
-        if i < 0: i = 0
-        result = x[i:j] + ',' + result
-    return result
+    head, tail = x[:-3], x[-3:]
+    groups = [head[max(i - 2, 0):i] for i in range(len(head), 0, -2)]
+    return ','.join(groups[::-1] + [tail])
 
 
 def wiki1():
     """Generate Wikipedia markup code for medical cases chart template."""
     ignore_dates = ('2020-02-04', '2020-02-21', '2020-02-27')
-    data = archive.load(ignore_dates=ignore_dates)
+    data = load_archive(ignore_dates)
     update = source = fetch_wiki_source(WIKI_SRC1)
     update = replace_within('Total confirmed -->\n',
                             '\n<!-- Date',
                             update, wiki1_data(data))
-    open('wiki1.txt', 'w').write(update)
-    open('wiki1.diff', 'w').write(diff(source, update))
+    fwrite('wiki1.txt', update)
+    fwrite('wiki1.diff', diff(source, update))
 
 
 def wiki1_data(data):
     """Generate data entries for medical cases chart template."""
     out = []
+    last_index = len(data.dates) - 1
+    # Number of days from each date to the next one.
+    gaps = [(b - a).days for a, b in zip(data.datetimes, data.datetimes[1:])]
 
     for i, (date, total, cured, death) in enumerate(zip(
             data.dates, data.total_cases, data.cured_cases, data.death_cases)):
@@ -130,15 +304,10 @@ def wiki1_data(data):
         out.append('{};{};{};{}'.format(date, death, cured, total))
 
         # Print continuation lines.
-        curr_index = data.dates.index(date)
-        if curr_index < len(data.dates) - 1:
-            curr_datetime = data.datetimes[curr_index]
-            next_datetime = data.datetimes[curr_index + 1]
-            if (next_datetime - curr_datetime).days != 1:
-                month = next_datetime.strftime('%b')
-                out.append(';{};{};{}'.format('' if death == 0 else death,
-                                              '' if cured == 0 else cured,
-                                              '' if total == 0 else total))
+        if i < last_index and gaps[i] != 1:
+            out.append(';{};{};{}'.format('' if death == 0 else death,
+                                          '' if cured == 0 else cured,
+                                          '' if total == 0 else total))
     return '\n'.join(out)
 
 
@@ -153,8 +322,8 @@ def wiki2():
                                     region_table_body(data))
     update = replace_within('nationals\n\|', r' cases are being reassigned',
                             update, reassigned)
-    open('wiki2.txt', 'w').write(update)
-    open('wiki2.diff', 'w').write(diff(source, update))
+    fwrite('wiki2.txt', update)
+    fwrite('wiki2.diff', diff(source, update))
 
 
 def region_table_head(data):
@@ -173,57 +342,22 @@ def region_table_head(data):
 
 def region_table_body(data):
     """Generate data rows for region table."""
-    region_names = (
-        'Andaman and Nicobar Islands',
-        'Andhra Pradesh',
-        'Arunachal Pradesh',
-        'Assam',
-        'Bihar',
-        'Chandigarh',
-        'Chhattisgarh',
-        'Dadra and Nagar Haveli and Daman and Diu',
-        'Delhi',
-        'Goa',
-        'Gujarat',
-        'Haryana',
-        'Himachal Pradesh',
-        'Jammu and Kashmir',
-        'Jharkhand',
-        'Karnataka',
-        'Kerala',
-        'Ladakh',
-        'Lakshadweep',
-        'Madhya Pradesh',
-        'Maharashtra',
-        'Manipur',
-        'Meghalaya',
-        'Mizoram',
-        'Nagaland',
-        'Odisha',
-        'Puducherry',
-        'Punjab',
-        'Rajasthan',
-        'Sikkim',
-        'Tamil Nadu',
-        'Telangana',
-        'Tripura',
-        'Uttarakhand',
-        'Uttar Pradesh',
-        'West Bengal',
-    )
+    region_keys = list(data.regions)
+    normalized = {_norm(k): k for k in region_keys}
     out = []
-    for i, name in enumerate(region_names, 1):
-        matches = difflib.get_close_matches(name, list(data.regions), 1)
-        key = None
-
-        if len(matches) != 0:
-            key = matches[0]
-        elif name == 'Dadra and Nagar Haveli and Daman and Diu':
-            candidates = ['Dadar Nagar Haveli', 'Dadra and Nagar Haveli']
-            for candidate in candidates:
-                if candidate in data.regions:
-                    key = candidate
-                    break
+    for i, name in enumerate(_REGION_NAMES, 1):
+        key = normalized.get(_norm(name))
+
+        if key is None:
+            matches = difflib.get_close_matches(name, region_keys, 1)
+            if len(matches) != 0:
+                key = matches[0]
+            elif name == 'Dadra and Nagar Haveli and Daman and Diu':
+                candidates = ['Dadar Nagar Haveli', 'Dadra and Nagar Haveli']
+                for candidate in candidates:
+                    if candidate in data.regions:
+                        key = candidate
+                        break
 
         if key is None:
             total, active, cured, death = 0, 0, 0, 0
@@ -234,57 +368,25 @@ def region_table_body(data):
                                        cf(cured), cf(death))
 
         if name == 'Assam':
-            total = str(total) + open('layout/fn1.txt').read().strip()
+            total = str(total) + _read_layout('layout/fn1.txt')
         elif name == 'Kerala':
-            death = str(death) + open('layout/fn2.txt').read().strip()
+            death = str(death) + _read_layout('layout/fn2.txt')
+
+        out.append('|-\n! scope="row" |{}\n|{}\n|{}\n|{}\n|{}'.format(
+            markup_region(name), markup_num(total), markup_num(death),
+            markup_num(cured), markup_num(active)))
+    return '\n'.join(out)
 
-        out.append('|-')
-        out.append('! scope="row" |{}'.format(markup_region(name)))
-        out.append('|{}'.format(markup_num(total)))
-        out.append('|{}'.format(markup_num(death)))
-        out.append('|{}'.format(markup_num(cured)))
-        out.append('|{}'.format(markup_num(active)))
-    out = '\n'.join(out)
-    return out
 
+def _norm(name):
+    """Return region name normalized for exact-match lookup."""
+    return name.lower().replace(' ', '')
 
+
+@functools.lru_cache(maxsize=None)
 def markup_region(name):
     """Generate Wikipedia markup to display region name in region table."""
-    if name in (
-        'Andhra Pradesh',
-        'Arunachal Pradesh',
-        'Assam',
-        'Bihar',
-        'Chandigarh',
-        'Chhattisgarh',
-        'Dadra and Nagar Haveli and Daman and Diu',
-        'Delhi',
-        'Goa',
-        'Gujarat',
-        'Haryana',
-        'Himachal Pradesh',
-        'Jammu and Kashmir',
-        'Jharkhand',
-        'Karnataka',
-        'Kerala',
-        'Ladakh',
-        'Madhya Pradesh',
-        'Maharashtra',
-        'Manipur',
-        'Meghalaya',
-        'Mizoram',
-        'Nagaland',
-        'Odisha',
-        'Puducherry',
-        'Rajasthan',
-        'Sikkim',
-        'Tamil Nadu',
-        'Telangana',
-        'Tripura',
-        'Uttarakhand',
-        'Uttar Pradesh',
-        'West Bengal'
-    ):
+    if name in _LINKED_REGIONS:
         return ('[[COVID-19 pandemic in {}|{}]]'
                 .format(name, name))
 
@@ -301,38 +403,35 @@ def markup_region(name):
 
 def markup_num(n_str):
     """Generate Wikipedia markup for case numbers in region table."""
-    return ' style="color:gray;" |0' if n_str == '0' else n_str
+    return _GRAY_ZERO if n_str == '0' else n_str
 
 
 def wiki3():
     """Generate Wikipedia markup code for statistics charts."""
     ignore_dates = ('2020-02-04', '2020-02-27')
-    data = archive.load(ignore_dates=ignore_dates)
+    data = load_archive(ignore_dates)
     update = source = fetch_wiki_source(WIKI_SRC3)
 
-    mini_dates = ', '.join(x.strftime('%d %b %Y').lstrip('0')
-                           for x in data.datetimes)
-    full_dates = ', '.join(x.strftime('%d %b %Y').lstrip('0')
-                           for x in data.datetimes)
+    formatted_dates = [x.strftime('%d %b %Y').lstrip('0')
+                       for x in data.datetimes]
+    full_dates = ', '.join(formatted_dates)
     # Cases.
-    total_cases = ', '.join(str(y) for y in data.total_cases)
-    active_cases = ', '.join(str(y) for y in data.active_cases)
-    cured_cases = ', '.join(str(y) for y in data.cured_cases)
-    death_cases = ', '.join(str(y) for y in data.death_cases)
+    total_cases = _csv(data.total_cases)
+    active_cases = _csv(data.active_cases)
+    cured_cases = _csv(data.cured_cases)
+    death_cases = _csv(data.death_cases)
     # New cases.
     total_dates, total_diffs = clean_data(data.datetimes, data.total_diffs)
     cured_dates, cured_diffs = clean_data(data.datetimes, data.cured_diffs)
     death_dates, death_diffs = clean_data(data.datetimes, data.death_diffs)
     # CFR
     cfr_start = data.dates.index('2020-03-12')
-    cfr_dates = ', '.join(x.strftime('%d %b %Y').lstrip('0')
-                      for x in data.datetimes[cfr_start:])
-    cfr_percents = ', '.join('{:.2f}'.format(y) for
-                             y in data.cfr_percents[cfr_start:])
+    cfr_dates = ', '.join(formatted_dates[cfr_start:])
+    cfr_percents = ', '.join(map('{:.2f}'.format,
+                                 data.cfr_percents[cfr_start:]))
 
     # For testing regex matches only.
     """
-    mini_dates = '@@mini_dates@@'
     full_dates = '@@full_dates@@'
     total_cases = '@@total_cases@@'
     active_cases = '@@active_cases@@'
@@ -344,56 +443,40 @@ def wiki3():
     cfr_dates, cfr_percents = '@@cfr_dates@@', '@@cfr_percents@@'
     """
 
-    # Linear graph.
-    update = replace_within('= Total confirmed.*?x = ', '\n',
-                            update, full_dates)
-    update = replace_within('= Total confirmed.*?y1 =.*?--> ', '\n',
-                            update, total_cases)
-    update = replace_within('= Total confirmed.*?y2 =.*?--> ', '\n',
-                            update, active_cases)
-    update = replace_within('= Total confirmed.*?y3 =.*?--> ', '\n',
-                            update, cured_cases)
-    update = replace_within('= Total confirmed.*?y4 =.*?--> ', '\n',
-                            update, death_cases)
-
-    # Logarithmic graph.
-    update = replace_within('= Total confirmed.*?log.*?x = ', '\n',
-                            update, full_dates)
-    update = replace_within('= Total confirmed.*?log.*?y1 =.*?--> ', '\n',
-                            update, total_cases)
-    update = replace_within('= Total confirmed.*?log.*?y2 =.*?--> ', '\n',
-                            update, active_cases)
-    update = replace_within('= Total confirmed.*?log.*?y3 =.*?--> ', '\n',
-                            update, cured_cases)
-    update = replace_within('= Total confirmed.*?log.*?y4 =.*?--> ', '\n',
-                            update, death_cases)
-
-    # Daily new cases.
-    update = replace_within('= Daily new cases.*?x = ', '\n',
-                            update, total_dates)
-    update = replace_within('= Daily new cases.*?y = ', '\n',
-                            update, total_diffs)
-
-    # Daily new deaths.
-    update = replace_within('= Daily new deaths.*?x = ', '\n',
-                            update, death_dates)
-    update = replace_within('= Daily new deaths.*?y = ', '\n',
-                            update, death_diffs)
-
-    # Daily new recoveries.
-    update = replace_within('= Daily new recoveries.*?x = ', '\n',
-                            update, cured_dates)
-    update = replace_within('= Daily new recoveries.*?y = ', '\n',
-                            update, cured_diffs)
-
-    # CFR.
-    update = replace_within('= Case fatality rate.*?x = ', '\n',
-                            update, cfr_dates)
-    update = replace_within('= Case fatality rate.*?y = ', '\n',
-                            update, cfr_percents)
-
-    open('wiki3.txt', 'w').write(update)
-    open('wiki3.diff', 'w').write(diff(source, update))
+    update = replace_all_within(update, [
+        # Linear graph.
+        ('= Total confirmed.*?x = ', '\n', full_dates),
+        ('= Total confirmed.*?y1 =.*?--> ', '\n', total_cases),
+        ('= Total confirmed.*?y2 =.*?--> ', '\n', active_cases),
+        ('= Total confirmed.*?y3 =.*?--> ', '\n', cured_cases),
+        ('= Total confirmed.*?y4 =.*?--> ', '\n', death_cases),
+
+        # Logarithmic graph.
+        ('= Total confirmed.*?log.*?x = ', '\n', full_dates),
+        ('= Total confirmed.*?log.*?y1 =.*?--> ', '\n', total_cases),
+        ('= Total confirmed.*?log.*?y2 =.*?--> ', '\n', active_cases),
+        ('= Total confirmed.*?log.*?y3 =.*?--> ', '\n', cured_cases),
+        ('= Total confirmed.*?log.*?y4 =.*?--> ', '\n', death_cases),
+
+        # Daily new cases.
+        ('= Daily new cases.*?x = ', '\n', total_dates),
+        ('= Daily new cases.*?y = ', '\n', total_diffs),
+
+        # Daily new deaths.
+        ('= Daily new deaths.*?x = ', '\n', death_dates),
+        ('= Daily new deaths.*?y = ', '\n', death_diffs),
+
+        # Daily new recoveries.
+        ('= Daily new recoveries.*?x = ', '\n', cured_dates),
+        ('= Daily new recoveries.*?y = ', '\n', cured_diffs),
+
+        # CFR.
+        ('= Case fatality rate.*?x = ', '\n', cfr_dates),
+        ('= Case fatality rate.*?y = ', '\n', cfr_percents),
+    ])
+
+    fwrite('wiki3.txt', update)
+    fwrite('wiki3.diff', diff(source, update))
 
 
 def clean_data(datetimes, numbers):
@@ -402,54 +485,40 @@ def clean_data(datetimes, numbers):
     cleaned_dates = []
     cleaned_numbers = []
 
-    mode = 'LEADING_ZEROS'
-    multiple_zeros_allowed = True
-
-    def normal_append(d, n):
-        nonlocal mode
-        mode = 'NORMAL'
-        cleaned_dates.append(d)
-        cleaned_numbers.append(n)
-
-    for i, (d, n) in enumerate(zip(formatted_dates, numbers)):
-        if mode == 'LEADING_ZEROS':
-            if n == 0:
-                continue
-            else:
-                normal_append(d, n)
-        elif mode == 'NORMAL':
-            if multiple_zeros_allowed and n == 0:
-                mode = 'SINGLE_ZERO'
-                continue
-            else:
-                normal_append(d, n)
-        elif mode == 'SINGLE_ZERO':
-            if n == 0:
-                mode = 'MULTIPLE_ZEROS'
-                cleaned_dates.append('...')
+    # Walk runs of zero and non-zero numbers instead of single entries.
+    # Leading zeros are dropped, a lone zero is kept unless it is the
+    # last entry, and the first run of multiple zeros collapses to a
+    # single '...' entry. Zeros after that collapse are kept as is.
+    collapsed = False
+    i = 0
+    for is_zero, run in itertools.groupby(numbers, operator.not_):
+        j = i + len(list(run))
+        if not is_zero or collapsed:
+            cleaned_dates.extend(formatted_dates[i:j])
+            cleaned_numbers.extend(numbers[i:j])
+        elif i == 0:
+            pass
+        elif j - i == 1:
+            if j < len(numbers):
+                cleaned_dates.append(formatted_dates[i])
                 cleaned_numbers.append(0)
-            else:
-                normal_append(formatted_dates[i - 1], 0)
-                normal_append(d, n)
-        elif mode == 'MULTIPLE_ZEROS':
-            if n == 0:
-                continue
-            else:
-                multiple_zeros_allowed = False
-                normal_append(d, n)
+        else:
+            cleaned_dates.append('...')
+            cleaned_numbers.append(0)
+            collapsed = True
+        i = j
 
-    return (', '.join(str(x) for x in cleaned_dates),
-            ', '.join(str(x) for x in cleaned_numbers))
+    return _csv(cleaned_dates), _csv(cleaned_numbers)
 
 
 def diffs():
     """Generate Wikipedia markup code to plot new cases."""
     print('\nNew cases per day:\n')
-    print('y =', ', '.join(str(y) for y in data.total_diffs))
+    print('y =', _csv(data.total_diffs))
     print('\nNew recoveries per day:\n')
-    print('y =', ', '.join(str(y) for y in data.cured_diffs))
+    print('y =', _csv(data.cured_diffs))
     print('\nNew deaths per day:\n')
-    print('y =', ', '.join(str(y) for y in data.death_diffs))
+    print('y =', _csv(data.death_diffs))
 
 
 def main():